@@ -8,11 +8,16 @@ Purpose: Monitor and kill processes using excessive RAM
 import psutil
 import time
 import logging
+import logging.handlers
+import queue
+import atexit
 import sys
+import threading
 import os
 from datetime import datetime
 import signal
 from pathlib import Path
+from typing import NamedTuple
 try:
     import tomllib  # Python 3.11+
 except ModuleNotFoundError:
@@ -40,161 +45,294 @@ def setup_logging(log_file):
     except PermissionError:
         logger.warning(f"Cannot write to {log_file}, logging to stdout only")
 
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # Write records from a background thread so slow handlers don't stall scans
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)  # Flush queued records on exit
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))  # Real formatting happens in the listener
+
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=handlers,
+        handlers=[queue_handler],
         force=True
     )
 
 
+class MemUsage(NamedTuple):
+    """Memory usage of a single process"""
+    rss: int  # Resident Set Size in bytes
+    percent: float  # RSS as a percentage of total RAM
+
+
 class MemoryMonitor:
+    # Skip the per-process scan while system usage is below this fraction of the thresholds
+    IDLE_PRESSURE_RATIO = 0.7
+    # Upper bound on the idle backoff, as a multiple of CHECK_INTERVAL
+    MAX_INTERVAL_MULTIPLIER = 4
+
     def __init__(self, config):
         self.config = config
         self.total_ram = psutil.virtual_memory().total
         self.ram_percent_threshold = config['RAM_PERCENT_THRESHOLD']
         self.ram_gb_threshold = config['RAM_GB_THRESHOLD'] * (1024 ** 3)  # Convert to bytes
+        self._ram_gb_threshold_display = config['RAM_GB_THRESHOLD']
+        self._dry_run = bool(config['DRY_RUN'])
+        self._rss_pct_bytes = int(self.ram_percent_threshold * self.total_ram / 100)  # Percent threshold in bytes
+
+        # Precompute whitelist lookups once instead of per process per scan
+        self._wl_names_lower = tuple(name.lower() for name in config['WHITELIST_NAMES'])
+        self._wl_pids = frozenset(config['WHITELIST_PIDS'])
+        self._wl_users = frozenset(config.get('WHITELIST_USERS') or ())
+        self._self_pid = os.getpid()
+
+        # Set by handle_signal() to wake the main loop and stop it
+        self._stop = threading.Event()
+        self._stop_signum = None
+
+        # Name and username never change for a given (pid, create_time)
+        self._attr_cache = {}
+        self._attr_cache_seen = set()
+
+        # On Linux, prefilter by reading /proc/<pid>/statm directly and only
+        # build psutil.Process objects for processes above a threshold
+        self._linux_fast_path = sys.platform.startswith('linux') and os.path.isdir('/proc')
+        if self._linux_fast_path:
+            self._page_size = os.sysconf('SC_PAGE_SIZE')
+            self._prefilter_rss = min(self.ram_gb_threshold, self._rss_pct_bytes)
 
         logger.info(f"Memory Monitor initialized")
         logger.info(f"Total RAM: {self.total_ram / (1024**3):.2f} GB")
         logger.info(f"Thresholds: {self.ram_percent_threshold}% or {config['RAM_GB_THRESHOLD']} GB")
         logger.info(f"Dry Run Mode: {config['DRY_RUN']}")
 
+    def get_process_attrs(self, process):
+        """Return (name, username) for a process, cached across scans"""
+        key = (process.pid, process.create_time())
+        self._attr_cache_seen.add(key)
+        attrs = self._attr_cache.get(key)
+        if attrs is None:
+            attrs = (process.name(), process.username())
+            self._attr_cache[key] = attrs
+        return attrs
+
     def is_whitelisted(self, process):
-        """Check if process should be protected from killing"""
-        try:
-            # Check PID whitelist
-            if process.pid in self.config['WHITELIST_PIDS']:
-                return True
+        """Check if process should be protected from killing
 
-            # Check process name whitelist
-            process_name = process.name().lower()
-            for protected_name in self.config['WHITELIST_NAMES']:
-                if protected_name.lower() in process_name:
-                    return True
+        psutil.NoSuchProcess/AccessDenied propagate to scan_processes, which skips the process.
+        """
+        # PID-only checks first: no /proc read needed
+        if process.pid in self._wl_pids:
+            return True
 
-            # Check user whitelist (optional)
-            if self.config.get('WHITELIST_USERS'):
-                username = process.username()
-                if username in self.config['WHITELIST_USERS']:
-                    return False  # Change to True if you want to protect root processes
+        # Don't kill this script itself
+        if process.pid == self._self_pid:
+            return True
 
-            # Don't kill this script itself
-            if process.pid == os.getpid():
-                return True
+        process_name, username = self.get_process_attrs(process)
 
-            return False
+        # Check process name whitelist
+        process_name = process_name.lower()
+        if any(protected_name in process_name for protected_name in self._wl_names_lower):
+            return True
+
+        # Check user whitelist (optional)
+        if self._wl_users:
+            if username in self._wl_users:
+                return False  # Change to True if you want to protect root processes
 
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            return True  # If we can't check, don't kill
+        return False
 
     def get_memory_usage(self, process):
         """Get memory usage of a process"""
-        try:
-            memory_info = process.memory_info()
-            memory_percent = process.memory_percent()
-            return {
-                'rss': memory_info.rss,  # Resident Set Size
-                'vms': memory_info.vms,  # Virtual Memory Size
-                'percent': memory_percent,
-                'rss_gb': memory_info.rss / (1024 ** 3)
-            }
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            return None
+        rss = process.memory_info().rss
+        return MemUsage(rss, rss * 100.0 / self.total_ram)  # Percent computed locally, avoids a second /proc read
 
     def should_kill_process(self, process):
         """Determine if process should be killed based on memory usage"""
         memory_usage = self.get_memory_usage(process)
 
-        if not memory_usage:
-            return False, None
-
         # Check percentage threshold
-        if memory_usage['percent'] > self.ram_percent_threshold:
-            return True, f"RAM usage {memory_usage['percent']:.2f}% exceeds {self.ram_percent_threshold}%"
+        if memory_usage.rss > self._rss_pct_bytes:
+            return True, 'percent', memory_usage
 
         # Check absolute GB threshold
-        if memory_usage['rss'] > self.ram_gb_threshold:
-            return True, f"RAM usage {memory_usage['rss_gb']:.2f}GB exceeds {self.config['RAM_GB_THRESHOLD']}GB"
+        if memory_usage.rss > self.ram_gb_threshold:
+            return True, 'gb', memory_usage
 
-        return False, None
+        return False, None, memory_usage
 
-    def kill_process(self, process):
-        """Kill a process gracefully, then forcefully if needed"""
+    def describe_kill_reason(self, reason, memory_usage):
+        """Format the threshold a process exceeded, as returned by should_kill_process()"""
+        if reason == 'percent':
+            return f"RAM usage {memory_usage.percent:.2f}% exceeds {self.ram_percent_threshold}%"
+        return f"RAM usage {memory_usage.rss / (1024 ** 3):.2f}GB exceeds {self._ram_gb_threshold_display}GB"
+
+    def get_cmdline(self, process):
+        """Get a bounded-length command line string for logging"""
+        if self._linux_fast_path:
+            # One bounded read instead of building the full argument list
+            try:
+                with open(f'/proc/{process.pid}/cmdline', 'rb') as f:
+                    raw = f.read(4096)
+            except OSError:
+                return 'N/A'
+            return raw.replace(b'\0', b' ').strip().decode('utf-8', 'replace') or 'N/A'
+
+        cmdline = process.cmdline()
+        return ' '.join(cmdline[:50]) if cmdline else 'N/A'
+
+    def kill_process(self, process, memory_usage):
+        """Send SIGTERM to a process; kill_processes() escalates to SIGKILL if needed"""
         try:
-            process_info = {
-                'pid': process.pid,
-                'name': process.name(),
-                'cmdline': ' '.join(process.cmdline()[:50]) if process.cmdline() else 'N/A',
-                'username': process.username(),
-                'memory': self.get_memory_usage(process)
-            }
-
-            if self.config['DRY_RUN']:
-                logger.warning(f"[DRY RUN] Would kill process: PID={process_info['pid']}, "
-                               f"Name={process_info['name']}, "
-                               f"User={process_info['username']}, "
-                               f"RAM={process_info['memory']['rss_gb']:.2f}GB "
-                               f"({process_info['memory']['percent']:.2f}%)")
+            name, username = self.get_process_attrs(process)
+            rss_gb = memory_usage.rss / (1024 ** 3)
+
+            # %-style arguments are only formatted if a handler consumes the record
+            if self._dry_run:
+                logger.warning("[DRY RUN] Would kill process: PID=%d, Name=%s, User=%s, RAM=%.2fGB (%.2f%%)",
+                               process.pid, name, username, rss_gb, memory_usage.percent)
                 return True
 
             # Log before killing
-            logger.warning(f"Killing process: PID={process_info['pid']}, "
-                           f"Name={process_info['name']}, "
-                           f"User={process_info['username']}, "
-                           f"RAM={process_info['memory']['rss_gb']:.2f}GB "
-                           f"({process_info['memory']['percent']:.2f}%), "
-                           f"CMD={process_info['cmdline']}")
+            logger.warning("Killing process: PID=%d, Name=%s, User=%s, RAM=%.2fGB (%.2f%%), CMD=%s",
+                           process.pid, name, username, rss_gb, memory_usage.percent,
+                           self.get_cmdline(process))
 
             # Try graceful termination first
             process.terminate()
-            time.sleep(5)  # Wait 5 seconds for graceful shutdown
-
-            # Force kill if still alive
-            if process.is_running():
-                process.kill()
-                logger.warning(f"Force killed PID {process.pid} (did not respond to SIGTERM)")
-
             return True
 
         except psutil.NoSuchProcess:
-            logger.info(f"Process {process.pid} already terminated")
+            logger.info("Process %d already terminated", process.pid)
             return True
         except psutil.AccessDenied:
-            logger.error(f"Access denied to kill PID {process.pid}")
+            logger.error("Access denied to kill PID %d", process.pid)
             return False
         except Exception as e:
-            logger.error(f"Error killing process {process.pid}: {e}")
+            logger.error("Error killing process %d: %s", process.pid, e)
             return False
 
+    def kill_processes(self, victims):
+        """Terminate all victims at once, then force kill those still alive after 5 seconds"""
+        killed_count = 0
+        terminated = []
+
+        # Largest offenders first, so the most memory is released soonest
+        victims = sorted(victims, key=lambda victim: victim[1].rss, reverse=True)
+
+        for process, memory_usage in victims:
+            if self.kill_process(process, memory_usage):
+                killed_count += 1
+                if not self._dry_run:
+                    terminated.append(process)
+
+        if not terminated:
+            return killed_count
+
+        # Wait for all processes in parallel rather than 5 seconds each
+        _, alive = psutil.wait_procs(terminated, timeout=5)
+        for process in alive:
+            try:
+                process.kill()
+                logger.warning("Force killed PID %d (did not respond to SIGTERM)", process.pid)
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.AccessDenied:
+                logger.error("Access denied to kill PID %d", process.pid)
+        if alive:
+            psutil.wait_procs(alive, timeout=2)
+
+        return killed_count
+
+    def _scan_processes_linux_fast(self):
+        """Read RSS for every PID from /proc/<pid>/statm, return (scanned, over-threshold processes)"""
+        scanned_count = 0
+        candidates = []
+
+        with os.scandir('/proc') as entries:
+            for entry in entries:
+                if not entry.name.isdigit():
+                    continue
+
+                try:
+                    with open(f'/proc/{entry.name}/statm', 'rb') as f:
+                        fields = f.read().split()
+                    vm_pages, rss_pages = int(fields[0]), int(fields[1])
+                except (OSError, IndexError, ValueError):
+                    continue  # Process exited or statm unreadable
+
+                scanned_count += 1
+                if vm_pages == 0:
+                    continue  # No address space: kernel thread or zombie, nothing to free
+
+                if rss_pages * self._page_size <= self._prefilter_rss:
+                    continue
+
+                try:
+                    candidates.append(psutil.Process(int(entry.name)))
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+
+        return scanned_count, candidates
+
     def scan_processes(self):
         """Scan all processes and kill those exceeding thresholds"""
-        killed_count = 0
         scanned_count = 0
+        victims = []
 
         logger.info("Starting process scan...")
 
-        for process in psutil.process_iter(['pid', 'name', 'username']):
+        fast_path = self._linux_fast_path
+        if fast_path:
+            scanned_count, processes = self._scan_processes_linux_fast()
+        else:
+            processes = psutil.process_iter()
+
+        # Local names avoid attribute lookups on every iteration
+        is_whitelisted = self.is_whitelisted
+        should_kill_process = self.should_kill_process
+        add_victim = victims.append
+
+        for process in processes:
             try:
-                scanned_count += 1
+                if not fast_path:
+                    scanned_count += 1
 
-                # Skip whitelisted processes
-                if self.is_whitelisted(process):
-                    continue
+                # Batch /proc reads for all attribute lookups on this process
+                with process.oneshot():
+                    # Skip whitelisted processes
+                    if is_whitelisted(process):
+                        continue
 
-                # Check if should kill
-                should_kill, reason = self.should_kill_process(process)
+                    # Check if should kill
+                    should_kill, reason, memory_usage = should_kill_process(process)
 
-                if should_kill:
-                    logger.info(f"Process {process.pid} ({process.name()}) marked for termination: {reason}")
-                    if self.kill_process(process):
-                        killed_count += 1
+                    if should_kill:
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("Process %d (%s) marked for termination: %s",
+                                         process.pid, self.get_process_attrs(process)[0],
+                                         self.describe_kill_reason(reason, memory_usage))
+                        add_victim((process, memory_usage))
 
             except (psutil.NoSuchProcess, psutil.AccessDenied):
-                continue
+                continue  # Process exited or can't be inspected: never kill it
             except Exception as e:
                 logger.error(f"Error processing PID {process.pid}: {e}")
 
+        killed_count = self.kill_processes(victims)
+
+        # Drop cached attributes for processes that were not seen this scan
+        self._attr_cache = {key: self._attr_cache[key]
+                            for key in self._attr_cache_seen if key in self._attr_cache}
+        self._attr_cache_seen = set()
+
         logger.info(f"Scan complete. Scanned: {scanned_count}, Killed: {killed_count}")
         return killed_count
 
@@ -202,6 +340,11 @@ class MemoryMonitor:
         """Main monitoring loop"""
         logger.info("Memory Monitor started")
 
+        base_interval = self.config['CHECK_INTERVAL']
+        max_interval = base_interval * self.MAX_INTERVAL_MULTIPLIER
+        interval = base_interval
+        next_tick = time.monotonic()
+
         while True:
             try:
                 # Log current system memory
@@ -209,24 +352,43 @@ class MemoryMonitor:
                 logger.info(f"System Memory: {mem.percent}% used "
                             f"({mem.used / (1024**3):.2f}GB / {mem.total / (1024**3):.2f}GB)")
 
-                # Scan and kill processes
-                self.scan_processes()
+                # A process's RSS (including file-backed pages) can't exceed the
+                # non-free memory, so skip the scan while that is well below both thresholds
+                resident = mem.total - mem.free
+                if (resident * 100.0 / mem.total < self.ram_percent_threshold * self.IDLE_PRESSURE_RATIO
+                        and resident < self.ram_gb_threshold):
+                    interval = min(interval * 2, max_interval)
+                    logger.info(f"Memory pressure low, skipping scan (next check in {interval}s)")
+                else:
+                    # Back to the configured cadence as soon as there is pressure
+                    interval = base_interval
+
+                    # Scan and kill processes
+                    self.scan_processes()
+
+                # Sleep until an absolute deadline so scan time doesn't add drift
+                next_tick += interval
+                now = time.monotonic()
+                if next_tick < now:
+                    next_tick = now  # Scan overran the interval, don't try to catch up
+                if self._stop.wait(next_tick - now):
+                    break
 
-                # Wait for next check
-                time.sleep(self.config['CHECK_INTERVAL'])
-
-            except KeyboardInterrupt:
-                logger.info("Received interrupt signal, shutting down...")
-                break
             except Exception as e:
                 logger.error(f"Unexpected error in main loop: {e}")
-                time.sleep(self.config['CHECK_INTERVAL'])
+                if self._stop.wait(self.config['CHECK_INTERVAL']):
+                    break
+                next_tick = time.monotonic()
 
+        if self._stop_signum is not None:
+            logger.info(f"Received signal {self._stop_signum}, shutting down...")
+        logger.info("Memory Monitor stopped")
 
-def handle_signal(signum, frame):
-    """Handle system signals"""
-    logger.info(f"Received signal {signum}, shutting down...")
-    sys.exit(0)
+    def handle_signal(self, signum, frame):
+        """Handle system signals by waking the main loop so it exits"""
+        # Logging is left to run(): the queue's lock isn't safe to take from a signal handler
+        self._stop_signum = signum
+        self._stop.set()
 
 
 def load_config():
@@ -274,12 +436,11 @@ def main():
     if os.geteuid() != 0:
         logger.warning("Not running as root. May not be able to kill all processes.")
 
-    # Setup signal handlers
-    signal.signal(signal.SIGTERM, handle_signal)
-    signal.signal(signal.SIGINT, handle_signal)
-
-    # Create and run monitor
+    # Create monitor and setup signal handlers
     monitor = MemoryMonitor(config)
+    signal.signal(signal.SIGTERM, monitor.handle_signal)
+    signal.signal(signal.SIGINT, monitor.handle_signal)
+
     monitor.run()
 
 
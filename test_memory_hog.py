@@ -15,12 +15,9 @@ def allocate_memory(megabytes=100):
     # Each character is roughly 1 byte, so we need megabytes * 1024 * 1024 bytes
     bytes_needed = megabytes * 1024 * 1024
 
-    # Allocate memory by creating a large byte array
-    memory_hog = bytearray(bytes_needed)
-
-    # Fill it with data to ensure it's actually allocated in RAM
-    for i in range(0, bytes_needed, 1024):
-        memory_hog[i] = i % 256
+    # Allocate memory by creating a large byte array filled with non-zero data,
+    # so every page is actually resident in RAM (repeating one byte is a C-level memset)
+    memory_hog = bytearray(b'\xab') * bytes_needed
 
     print(f"Successfully allocated {megabytes}MB")
     print(f"Process PID: {sys.argv[0] if len(sys.argv) > 0 else 'unknown'}")